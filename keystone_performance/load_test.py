@@ -1,8 +1,11 @@
 
 import argparse
+import collections
 import datetime
 import itertools
 import json
+import math
+import os
 import time
 
 import numpy
@@ -44,6 +47,118 @@ class StringProducer(object):
         pass
 
 
+class LatencyHistogram(object):
+    """Fixed-size histogram of response times.
+
+    The buckets are logarithmically spaced so that memory use doesn't depend
+    on the number of samples while percentiles stay within about 1% of the
+    real value.
+
+    """
+
+    _MIN_VAL = 0.0001  # seconds, everything faster goes in the first bucket.
+    _MAX_VAL = 600.0  # seconds, everything slower goes in the last bucket.
+    _GROWTH = 1.01  # each bucket is 1% wider than the previous one.
+    _BUCKET_COUNT = int(
+        math.ceil(math.log(_MAX_VAL / _MIN_VAL) / math.log(_GROWTH))) + 2
+
+    def __init__(self):
+        self._buckets = numpy.zeros(self._BUCKET_COUNT, dtype=numpy.int64)
+        self.measure_count = 0
+        self.failure_count = 0
+        self.min_val = None
+        self.max_val = None
+        self._sum = 0.0
+        self._sum_sq = 0.0
+
+    @classmethod
+    def _bucket_idx(cls, val):
+        if val <= cls._MIN_VAL:
+            return 0
+        idx = int(math.log(val / cls._MIN_VAL) / math.log(cls._GROWTH)) + 1
+        return min(idx, cls._BUCKET_COUNT - 1)
+
+    @classmethod
+    def _bucket_upper_bound(cls, idx):
+        return cls._MIN_VAL * cls._GROWTH ** idx
+
+    def add(self, val):
+        self._buckets[self._bucket_idx(val)] += 1
+        self.measure_count += 1
+        self._sum += val
+        self._sum_sq += val * val
+        if self.min_val is None or val < self.min_val:
+            self.min_val = val
+        if self.max_val is None or val > self.max_val:
+            self.max_val = val
+
+    def add_failure(self):
+        self.failure_count += 1
+
+    def percentile(self, p):
+        if not self.measure_count:
+            return None
+        rank = max(1, int(math.ceil(p / 100.0 * self.measure_count)))
+        idx = int(numpy.searchsorted(numpy.cumsum(self._buckets), rank))
+        if idx == self._BUCKET_COUNT - 1:
+            # The last bucket has no upper bound.
+            return self.max_val
+        val = self._bucket_upper_bound(idx)
+        # The bucket bound can be outside of what was actually measured.
+        return min(max(val, self.min_val), self.max_val)
+
+    def std(self):
+        mean = self._sum / self.measure_count
+        return math.sqrt(max(self._sum_sq / self.measure_count - mean * mean,
+                             0.0))
+
+    def stats(self):
+        """Returns the same stats as RequestGatherer, plus p99."""
+        total_count = self.measure_count + self.failure_count
+        if not total_count:
+            return None
+
+        ret = {}
+        ret['measure_count'] = self.measure_count
+        ret['failure_count'] = self.failure_count
+        ret['failure_rate'] = float(self.failure_count) / total_count * 100
+
+        if not self.measure_count:
+            return ret
+
+        ret['min_val'] = self.min_val
+        ret['max_val'] = self.max_val
+        ret['p50'] = self.percentile(50)
+        ret['p90'] = self.percentile(90)
+        ret['p99'] = self.percentile(99)
+        ret['std'] = self.std()
+        return ret
+
+    def to_dict(self):
+        """Returns the histogram in a form that can be written as JSON.
+
+        Only the non-empty buckets are included, keyed by the bucket's upper
+        bound in seconds. The last bucket holds everything slower than
+        _MAX_VAL so its bound is None.
+
+        """
+        buckets = []
+        for idx in numpy.nonzero(self._buckets)[0]:
+            if idx == self._BUCKET_COUNT - 1:
+                bound = None
+            else:
+                bound = self._bucket_upper_bound(idx)
+            buckets.append([bound, int(self._buckets[idx])])
+        return {
+            'min_bound': self._MIN_VAL,
+            'growth': self._GROWTH,
+            'buckets': buckets,
+            'min_val': self.min_val,
+            'max_val': self.max_val,
+            'failure_count': self.failure_count,
+        }
+
+
 class TestTracker(object):
     def __init__(self, args):
         self._args = args
@@ -53,6 +168,9 @@ class TestTracker(object):
         if args.type == 'quick':
             self._run_time = 15  # seconds
             self._concurrencies = [1, 2, 4, 8]
+        elif args.type == 'soak':
+            self._run_time = args.soak_duration * 60 * 60  # hours to seconds
+            self._concurrencies = [args.soak_concurrency]
         else:  # Full run
             self._run_time = 60  # seconds
             self._concurrencies = [
@@ -67,9 +185,7 @@ class TestTracker(object):
         self._concurrency = self._concurrencies[self._concurrency_idx]
         print("Kicking off testing at concurrency {0}".format(
             self._concurrency))
-        self._request_gatherer = (
-            RequestGatherer(self._concurrency,
-                            on_test_started=self._test_started))
+        self._request_gatherer = self._create_request_gatherer()
         self._requests = []
 
         for i in range(self._concurrency):
@@ -80,6 +196,20 @@ class TestTracker(object):
 
         self._request_gatherer.start()
 
+    def _create_request_gatherer(self):
+        if self._args.type == 'soak':
+            return SoakGatherer(
+                self._concurrency, on_test_started=self._test_started,
+                out_dir=self._args.soak_dir,
+                window=self._args.soak_window,
+                trend_windows=self._args.soak_trend_windows,
+                trend_span=self._args.soak_trend_span,
+                stall_windows=self._args.soak_stall_windows,
+                drift_threshold=self._args.drift_threshold,
+                error_drift_threshold=self._args.error_drift_threshold)
+        return RequestGatherer(self._concurrency,
+                               on_test_started=self._test_started)
+
     def _test_started(self):
         reactor.callLater(self._run_time, self._done)
         self._start_time = datetime.datetime.utcnow()
@@ -223,6 +353,191 @@ class RequestGatherer(object):
         self._print_delayed_call = reactor.callLater(3, self._print)
 
 
+class SoakGatherer(RequestGatherer):
+    """RequestGatherer for long-running tests at a single concurrency.
+
+    Response times are kept in fixed-size histograms rather than a list so
+    memory stays constant no matter how long the test runs. Every hour the
+    histogram is written to out_dir and a summary is kept for the final
+    report. Every window seconds the p90, p99 and failure rate of the window
+    are recorded and a linear regression over the last trend_windows windows
+    is used to warn when they drift. No drift is reported until the windows
+    cover at least trend_span hours, since the slope over a few minutes is
+    mostly noise. If no requests complete for stall_windows windows in a row
+    there's nothing to fit, so that's warned about separately.
+
+    """
+
+    _HOUR = 60 * 60  # seconds
+
+    def __init__(self, concurrency, on_test_started, out_dir, window,
+                 trend_windows, trend_span, stall_windows, drift_threshold,
+                 error_drift_threshold):
+        self._out_dir = out_dir
+        self._window = window
+        self._trend_span = trend_span
+        self._stall_windows = stall_windows
+        self._drift_threshold = drift_threshold
+        self._error_drift_threshold = error_drift_threshold
+
+        self._windows = collections.deque(maxlen=trend_windows)
+        self._drift = {}
+        self._drifting = set()
+        self._empty_windows = 0
+        self._hourly = []
+        self._hour_no = 0
+        self._hour_start_time = None
+        self._window_delayed_call = None
+        self._hour_delayed_call = None
+
+        super(SoakGatherer, self).__init__(concurrency, on_test_started)
+
+    def _reset(self):
+        self._total_hist = LatencyHistogram()
+        self._hour_hist = LatencyHistogram()
+        self._window_hist = LatencyHistogram()
+
+    def _notify_startup_reset(self):
+        super(SoakGatherer, self)._notify_startup_reset()
+        self._hour_start_time = self._start_time
+        self._window_delayed_call = (
+            reactor.callLater(self._window, self._roll_window))
+        self._hour_delayed_call = (
+            reactor.callLater(self._HOUR, self._roll_hour))
+
+    def _add_response(self, time_or_none):
+        for hist in (self._total_hist, self._hour_hist, self._window_hist):
+            if time_or_none is None:
+                hist.add_failure()
+            else:
+                hist.add(time_or_none)
+
+    def _calc_stats(self):
+        return self._total_hist.stats()
+
+    def _elapsed_hours(self):
+        elapsed = datetime.datetime.utcnow() - self._start_time
+        return elapsed.total_seconds() / self._HOUR
+
+    def _roll_window(self):
+        stats = self._window_hist.stats()
+        self._window_hist = LatencyHistogram()
+        self._window_delayed_call = (
+            reactor.callLater(self._window, self._roll_window))
+
+        if stats is None:
+            # Nothing completed in this window, so there's no point to add,
+            # but requests hanging is the worst kind of drift.
+            self._empty_windows += 1
+            if self._empty_windows == self._stall_windows:
+                print("{0} WARNING: no requests completed in the last {1} "
+                      "windows".format(timestamp(), self._empty_windows))
+            return
+
+        if self._empty_windows >= self._stall_windows:
+            print("{0} Requests completing again after {1} empty "
+                  "windows".format(timestamp(), self._empty_windows))
+        self._empty_windows = 0
+
+        # A window where every request failed has no latencies but its
+        # failure rate still counts.
+        self._windows.append((self._elapsed_hours(), stats.get('p90'),
+                              stats.get('p99'), stats['failure_rate']))
+        self._check_drift()
+
+    def _check_drift(self):
+        # Latency drift is relative to the mean latency, in %/hour. Failure
+        # rate is already a percentage so its drift is in points/hour.
+        for idx, name, relative, threshold in [
+                (1, 'p90', True, self._drift_threshold),
+                (2, 'p99', True, self._drift_threshold),
+                (3, 'failure_rate', False, self._error_drift_threshold)]:
+            points = [(w[0], w[idx]) for w in self._windows
+                      if w[idx] is not None]
+            # Need enough points over a long enough time for the slope to
+            # mean anything.
+            span = points[-1][0] - points[0][0] if points else 0
+            if len(points) < 3 or span < self._trend_span:
+                self._drift.pop(name, None)
+                self._drifting.discard(name)
+                continue
+
+            hours, vals = (numpy.array(v) for v in zip(*points))
+            slope = numpy.polyfit(hours, vals, 1)[0]
+            if relative:
+                slope = slope / numpy.mean(vals) * 100
+            self._drift[name] = slope
+
+            # Only print when the metric crosses the threshold, otherwise
+            # the warning would be repeated every window.
+            units = '%' if relative else ' points'
+            if slope > threshold and name not in self._drifting:
+                self._drifting.add(name)
+                print("{0} WARNING: {1} drifting {2:+.2f}{3}/hour over the "
+                      "last {4:.2f} hours (threshold {5}{3}/hour)".format(
+                          timestamp(), name, slope, units,
+                          hours[-1] - hours[0], threshold))
+            elif slope <= threshold and name in self._drifting:
+                self._drifting.remove(name)
+                print("{0} {1} drift back to {2:+.2f}{3}/hour "
+                      "(threshold {4}{3}/hour)".format(
+                          timestamp(), name, slope, units, threshold))
+
+    def _roll_hour(self):
+        self._hour_delayed_call = (
+            reactor.callLater(self._HOUR, self._roll_hour))
+        self._write_hour()
+
+    def _write_hour(self):
+        end_time = datetime.datetime.utcnow()
+        stats = self._hour_hist.stats()
+        hist = self._hour_hist
+        self._hour_hist = LatencyHistogram()
+        start_time = self._hour_start_time
+        self._hour_start_time = end_time
+
+        hour = self._hour_no
+        self._hour_no += 1
+
+        if stats is None:
+            # Keep a record of hours where nothing completed so the gap
+            # shows up in the results.
+            stats = {'measure_count': 0, 'failure_count': 0}
+        stats['hour'] = hour
+        stats['start_time'] = format_timestamp(start_time)
+        stats['end_time'] = format_timestamp(end_time)
+        for name in ('p90', 'p99', 'failure_rate'):
+            stats['%s_drift' % name] = self._drift.get(name)
+        self._hourly.append(stats)
+
+        file_name = os.path.join(self._out_dir,
+                                 'soak-hour-{0:04d}.json'.format(hour))
+        try:
+            with open(file_name, 'w') as f:
+                json.dump({'stats': stats, 'histogram': hist.to_dict()}, f)
+        except (IOError, OSError) as e:
+            # Don't let a full disk stop the test from shutting down.
+            print("{0} Failed to write hourly results to {1}: {2}".format(
+                timestamp(), file_name, e))
+            return
+        print("{0} Wrote hourly results to {1}".format(timestamp(),
+                                                       file_name))
+
+    def notify_complete(self):
+        for delayed_call in (self._window_delayed_call,
+                             self._hour_delayed_call):
+            if delayed_call and delayed_call.active():
+                delayed_call.cancel()
+
+        stats = super(SoakGatherer, self).notify_complete()
+        if self._hour_start_time:
+            # Save the partial last hour too.
+            self._write_hour()
+        if stats is not None:
+            stats['hourly'] = self._hourly
+        return stats
+
+
 class Request(object):
     def __init__(self, agent, request_gatherer, args, on_complete=None):
         self._agent = agent
@@ -317,6 +632,61 @@ def print_summary(results):
             "std_deviation: {std}".format(**s))
 
 
+def _format_drift(drift, units):
+    if drift is None:
+        return '-'
+    return '{0:+.2f}{1}/hour'.format(drift, units)
+
+
+def print_soak_summary(results):
+    for s in results:
+        hourly = s.get('hourly')
+        if not hourly:
+            continue
+
+        # Compare against the first hour that has latencies.
+        first = None
+        for h in hourly:
+            if 'p90' in h:
+                first = h
+                break
+
+        print("\nDrift over time (relative to the first hour):")
+        for h in hourly:
+            drift = {
+                'p90_drift': _format_drift(h.get('p90_drift'), '%'),
+                'p99_drift': _format_drift(h.get('p99_drift'), '%'),
+                'failure_rate_drift': _format_drift(
+                    h.get('failure_rate_drift'), ' points'),
+            }
+            if not h['measure_count'] and not h['failure_count']:
+                print("hour: {hour} start_time: {start_time} "
+                      "end_time: {end_time} "
+                      "no requests completed".format(**h))
+                continue
+            if 'p90' not in h:
+                print("hour: {hour} start_time: {start_time} "
+                      "failures: {failure_count} "
+                      "failure_rate: {failure_rate:.3f} "
+                      "failure_rate_drift: {failure_rate_drift}".format(
+                          **dict(h, **drift)))
+                continue
+            print(
+                "hour: {hour} start_time: {start_time} "
+                "measurements: {measure_count} "
+                "failure_rate: {failure_rate:.3f} p90: {p90} p99: {p99} "
+                "p90_change: {p90_change:+.2f}% "
+                "p99_change: {p99_change:+.2f}% "
+                "failure_rate_change: {failure_rate_change:+.3f} "
+                "p90_drift: {p90_drift} p99_drift: {p99_drift} "
+                "failure_rate_drift: {failure_rate_drift}".format(
+                    p90_change=(h['p90'] / first['p90'] - 1) * 100,
+                    p99_change=(h['p99'] / first['p99'] - 1) * 100,
+                    failure_rate_change=(
+                        h['failure_rate'] - first['failure_rate']),
+                    **dict(h, **drift)))
+
+
 def write_out_file(out_file_name, results):
     with open(out_file_name, 'w') as f:
         for s in results:
@@ -336,16 +706,56 @@ def main():
     parser.add_argument('--project-id')
     parser.add_argument('--project-domain-name', default='Default')
     parser.add_argument('--project-domain-id')
-    parser.add_argument('--type', default='full', choices=['full', 'quick'])
+    parser.add_argument('--type', default='full',
+                        choices=['full', 'quick', 'soak'])
     parser.add_argument('--out-file')
+    parser.add_argument('--soak-concurrency', type=int, default=10)
+    parser.add_argument('--soak-duration', type=float, default=24,
+                        help='Hours')
+    parser.add_argument('--soak-window', type=int, default=60,
+                        help='Seconds')
+    parser.add_argument('--soak-trend-windows', type=int, default=60)
+    parser.add_argument('--soak-trend-span', type=float, default=0.5,
+                        help='Hours')
+    parser.add_argument('--soak-stall-windows', type=int, default=3)
+    parser.add_argument('--soak-dir', default='soak-results')
+    parser.add_argument('--drift-threshold', type=float, default=10.0,
+                        help='Percent per hour')
+    parser.add_argument('--error-drift-threshold', type=float, default=1.0,
+                        help='Percentage points per hour')
     args = parser.parse_args()
 
+    if args.type == 'soak':
+        if args.soak_window <= 0:
+            parser.error('--soak-window must be greater than 0')
+        if args.soak_trend_windows < 3:
+            parser.error('--soak-trend-windows must be at least 3')
+        if args.soak_stall_windows < 1:
+            parser.error('--soak-stall-windows must be at least 1')
+        trend_hours = (
+            float(args.soak_trend_windows - 1) * args.soak_window / 60 / 60)
+        if args.soak_trend_span > trend_hours:
+            parser.error(
+                '--soak-trend-span is longer than the {0:.2f} hours covered '
+                'by --soak-trend-windows'.format(trend_hours))
+        # Check the results can be written before putting any load on the
+        # server.
+        try:
+            if not os.path.isdir(args.soak_dir):
+                os.makedirs(args.soak_dir)
+        except OSError as e:
+            parser.error('Failed to create --soak-dir: {0}'.format(e))
+        if not os.access(args.soak_dir, os.W_OK):
+            parser.error('--soak-dir {0} is not writable'.format(
+                args.soak_dir))
+
     test_tracker = TestTracker(args)
     test_tracker.start()
 
     reactor.run()
 
     print_summary(test_tracker.stats)
+    print_soak_summary(test_tracker.stats)
     if args.out_file:
         write_out_file(args.out_file, test_tracker.stats)
 